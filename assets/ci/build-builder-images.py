@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
+import os
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import builder_image
 
 # Pass the registry hostname:port as argv[1]
 REGISTRY = sys.argv[1]
@@ -9,17 +13,11 @@ REGISTRY = sys.argv[1]
 
 # This script builds a docker image that helps to speed up running
 # the build. It is not required to run kumomta itself.
-# The images are based on the list of IMAGES below, but with any
-# additional dependencies that are required for building pre-installed.
+# The images are based on the IMAGES list in builder_image.py,
+# but with any additional dependencies that are required for building
+# pre-installed.
 
-IMAGES = [
-    "ubuntu:20.04",
-    "ubuntu:22.04",
-    "rockylinux:8",
-    "rockylinux:9",
-    "amazonlinux:2",
-    "amazonlinux:2023",
-]
+IMAGES = builder_image.IMAGES
 
 if len(sys.argv) > 2:
     IMAGE_NAME = sys.argv[2]
@@ -27,96 +25,58 @@ if len(sys.argv) > 2:
         raise Exception(f"invalid image name {IMAGE_NAME}")
     IMAGES = [IMAGE_NAME]
 
-for container in IMAGES:
-    dockerfile = f"""
-FROM {container}\n
-WORKDIR /tmp
-COPY ./get-deps.sh .
-LABEL org.opencontainers.image.source=https://github.com/KumoCorp/kumomta
-LABEL org.opencontainers.image.description="Build environment for CI"
-LABEL org.opencontainers.image.licenses="Apache"
-"""
-
-    commands = [
-        "curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y",
-        ". $HOME/.cargo/env",
-        "/tmp/get-deps.sh",
-        "curl -LsSf https://get.nexte.st/latest/linux | tar zxf - -C /usr/local/bin",
-        "cargo install --locked sccache --no-default-features --features s3",
-    ]
-
-    if "ubuntu" in container:
-        doc_deps = []
-        if "ubuntu:22.04" in container:
-            doc_deps += ["podman"]
-
-        commands = (
-            [
-                "echo 'debconf debconf/frontend select Noninteractive' | debconf-set-selections",
-                "apt update",
-                "apt install -yqq --no-install-recommends "
-                + " ".join(
-                    [
-                        "ca-certificates",
-                        "curl",
-                        "git",
-                        "jq",
-                        "pip",
-                    ]
-                    + doc_deps
-                ),
-            ]
-            + commands
-            + ["cargo install --locked gelatyx"]
-            + [
-                "pip3 install --quiet "
-                + " ".join(
-                    [
-                        "black",
-                    ]
-                )
-            ]
-        )
-
-        dockerfile += "ENV DEBIAN_FRONTEND=noninteractive\n"
-        dockerfile += "RUN rm -f /etc/apt/apt.conf.d/docker-clean\n"
-        dockerfile += (
-            "RUN --mount=type=cache,target=/var/cache/apt "
-            + " && ".join(commands)
-            + "\n"
-        )
+ARM = os.getenv("ARM") == "1"
+BUILD_ENV = dict(os.environ, DOCKER_BUILDKIT="1", BUILDX_GIT_LABELS="1")
 
-    if "rocky" in container:
-        commands = [
-            "dnf install -y git rpm-sign gnupg2",
-            # Some systems have curl-minimal which won't tolerate us installing curl
-            "command -v curl || dnf install -y curl",
-        ] + commands
-        dockerfile += "RUN " + " && ".join(commands) + "\n"
-
-    if "amazonlinux" in container:
-        if container == "amazonlinux:2":
-            gpg = "yum install -y gnupg2"
-        else:
-            gpg = "yum install -y gnupg2 --allowerasing"
-        commands = [
-            gpg,
-            "yum install -y git rpm-sign",
-            # Some systems have curl-minimal which won't tolerate us installing curl
-            "command -v curl || yum install -y curl",
-        ] + commands
-        dockerfile += "RUN " + " && ".join(commands) + "\n"
 
+def build_and_push(container):
+    # As before the generators were merged, local images build sccache
+    # with S3 storage support, and don't include xcp
+    dockerfile = builder_image.render(
+        container, arm=ARM, sccache_features=("s3",), cargo_tools=()
+    )
     print(dockerfile)
 
     tag = f"{REGISTRY}/kumocorp/builder-for-{container}"
 
+    # Warm the local cache from the previously published image, if any;
+    # this is best effort as the image won't exist the first time around
+    subprocess.run(["docker", "pull", tag])
+
     subprocess.run(
-        ["docker", "build", "--file", "-", "-t", tag, "."],
+        [
+            "docker",
+            "build",
+            "--progress=plain",
+            "--cache-from",
+            tag,
+            "--build-arg",
+            "BUILDKIT_INLINE_CACHE=1",
+            "--file",
+            "-",
+            "-t",
+            tag,
+            ".",
+        ],
         input=dockerfile,
         encoding="utf-8",
+        env=BUILD_ENV,
+        check=True,
     )
 
     print(f"Created {tag}")
 
-    subprocess.run(["docker", "push", tag])
+    subprocess.run(["docker", "push", tag], check=True)
+    return tag
+
+
+# The images share no layers, so build them all at the same time
+# rather than one after the other.  Each image is pushed as soon as it
+# is built, so the pushes also overlap with each other and with the
+# remaining builds.  How many layers of a single image are uploaded in
+# parallel is a docker daemon setting; raise max-concurrent-uploads in
+# /etc/docker/daemon.json if you have the upstream bandwidth to spare.
+with ThreadPoolExecutor(max_workers=min(len(IMAGES), os.cpu_count() or 1)) as executor:
+    futures = [executor.submit(build_and_push, container) for container in IMAGES]
+    for future in as_completed(futures):
+        print(f"Pushed {future.result()}")
@@ -0,0 +1,217 @@
+"""Generates the Dockerfiles for the images that we use to build kumomta
+in CI.  Used by both emit-builder-dockerfile.py (CI) and
+build-builder-images.py (local builds)."""
+
+IMAGES = [
+    "ubuntu:20.04",
+    "ubuntu:22.04",
+    "rockylinux:8",
+    "rockylinux:9",
+    "amazonlinux:2",
+    "amazonlinux:2023",
+]
+
+
+def cache_mounts(container, *targets):
+    """Returns the BuildKit RUN flags to persist the given directories
+    across builds of the image.  Each image gets its own cache ids, as
+    they otherwise default to the target path, so that concurrent builds
+    of different images don't queue on each other's locks or mix up the
+    packages of different distros"""
+    return " ".join(
+        f"--mount=type=cache,id={target}-{container},target={target},sharing=locked"
+        for target in targets
+    )
+
+
+def keep_rpm_cache(conf):
+    """Returns a command that configures dnf/yum to keep downloaded
+    packages in the cache dir, so that the cache mount has something in it"""
+    return f"sed -i -e '/^keepcache=/d' -e '/^\\[main\\]/a keepcache=1' {conf}"
+
+
+# The cargo installs are the slowest part of building the image, so
+# they get their own RUN with persistent caches for the crates.io index,
+# git checkouts and sccache.  sccache is installed first so that it can
+# be used to speed up compiling the tools that follow it.
+CARGO_CACHE_DIRS = (
+    "/root/.cargo/registry",
+    "/root/.cargo/git/db",
+    "/root/.cache/sccache",
+)
+
+CARGO_BINSTALL = (
+    "https://raw.githubusercontent.com/cargo-bins/cargo-binstall"
+    + "/main/install-from-binstall-release.sh"
+)
+
+
+def run(mounts, commands):
+    """Returns a RUN instruction that executes commands in sequence,
+    with the given cache mounts"""
+    return "RUN " + " ".join(mounts + [" && ".join(commands)]) + "\n"
+
+
+def render(container, *, arm=False, sccache_features=(), cargo_tools=("xcp",)):
+    """Returns the Dockerfile for the builder image based on container.
+
+    sccache_features lists the sccache features to build in, on top of
+    its minimal build, and cargo_tools the crates to install alongside
+    it; gelatyx is always added for ubuntu.  The defaults are what CI
+    uses; build-builder-images.py passes its own.
+
+    The steps are split across several RUN instructions, ordered from
+    the least to the most frequently changing, so that changing eg:
+    get-deps.sh doesn't invalidate the rustup and package layers.
+
+    The cargo tools are compiled in their own stage, on top of a
+    toolchain stage that has just the distro packages and rustup, so
+    that BuildKit can build them concurrently with get-deps.sh and the
+    rest of the final stage, and so that changing get-deps.sh doesn't
+    throw them away."""
+    if container not in IMAGES:
+        raise Exception(f"invalid image name {container}")
+
+    dockerfile = f"""# syntax=docker/dockerfile:1
+FROM {container} AS toolchain
+WORKDIR /tmp
+ENV CARGO_HOME=/root/.cargo RUSTUP_HOME=/root/.rustup SCCACHE_DIR=/root/.cache/sccache
+ENV PATH=/root/.cargo/bin:$PATH
+"""
+
+    nextest = "https://get.nexte.st/latest/linux"
+    if arm:
+        nextest = "https://get.nexte.st/latest/linux-arm"
+
+    cargo_tools = list(cargo_tools)
+    pip_packages = []
+
+    if "ubuntu" in container:
+        doc_deps = []
+        if "ubuntu:22.04" in container:
+            doc_deps += ["podman"]
+
+        package_cache = cache_mounts(container, "/var/cache/apt")
+        packages = [
+            "echo 'debconf debconf/frontend select Noninteractive' | debconf-set-selections",
+            "apt update",
+            "apt install -yqq --no-install-recommends "
+            + " ".join(
+                [
+                    "ca-certificates",
+                    "curl",
+                    "git",
+                    "jq",
+                    "pip",
+                ]
+                + doc_deps
+            ),
+        ]
+        # This uses the package lists fetched by the apt update above
+        build_deps = [
+            "apt install -yqq --no-install-recommends "
+            + "build-essential libssl-dev pkg-config"
+        ]
+
+        cargo_tools += ["gelatyx"]
+        pip_packages += ["black"]
+
+        dockerfile += "ENV DEBIAN_FRONTEND=noninteractive\n"
+        # The stock docker config deletes downloaded packages after every
+        # install, which defeats the cache mount
+        dockerfile += (
+            "RUN rm -f /etc/apt/apt.conf.d/docker-clean"
+            + " && echo 'Binary::apt::APT::Keep-Downloaded-Packages \"true\";'"
+            + " > /etc/apt/apt.conf.d/keep-cache\n"
+        )
+
+    if "rocky" in container:
+        package_cache = cache_mounts(container, "/var/cache/dnf")
+        packages = [
+            keep_rpm_cache("/etc/dnf/dnf.conf"),
+            "dnf install -y git rpm-sign gnupg2",
+            # Some systems have curl-minimal which won't tolerate us installing curl
+            "command -v curl || dnf install -y curl",
+        ]
+        build_deps = ["dnf install -y gcc make openssl-devel pkg-config"]
+
+    if "amazonlinux" in container:
+        if container == "amazonlinux:2":
+            gpg = "yum install -y gnupg2"
+            # The stock openssl is too old to build against
+            openssl = "openssl11-devel"
+            yum_conf = "/etc/yum.conf"
+            package_cache = cache_mounts(container, "/var/cache/yum")
+        else:
+            # yum is really dnf on amazonlinux:2023
+            gpg = "yum install -y gnupg2 --allowerasing"
+            openssl = "openssl-devel"
+            yum_conf = "/etc/dnf/dnf.conf"
+            package_cache = cache_mounts(container, "/var/cache/dnf")
+        packages = [
+            keep_rpm_cache(yum_conf),
+            gpg,
+            "yum install -y git rpm-sign",
+            # Some systems have curl-minimal which won't tolerate us installing curl
+            "command -v curl || yum install -y curl",
+        ]
+        build_deps = [f"yum install -y gcc make {openssl} pkgconfig"]
+
+    dockerfile += run([package_cache], packages)
+    dockerfile += run(
+        [],
+        ["curl --proto '=https' --tlsv1.2 -sSf https://sh.rustup.rs | sh -s -- -y"],
+    )
+
+    dockerfile += "\nFROM toolchain AS cargo-tools\n"
+    # Only what is needed to compile the tools, rather than running
+    # get-deps.sh, so that this stage doesn't depend on it
+    dockerfile += run([package_cache], build_deps)
+    # sccache is always compiled, as we want it without the default
+    # features.  The other tools come from prebuilt release binaries via
+    # cargo-binstall where possible, which falls back to compiling them
+    # (using sccache) when there is no suitable binary
+    sccache = "cargo install --locked sccache --no-default-features"
+    if sccache_features:
+        sccache += " --features " + ",".join(sccache_features)
+    cargo_commands = [sccache]
+    if cargo_tools:
+        cargo_commands += [
+            f"curl -L --proto '=https' --tlsv1.2 -sSf {CARGO_BINSTALL} | bash",
+            "RUSTC_WRAPPER=sccache cargo binstall --no-confirm --locked "
+            + " ".join(cargo_tools),
+        ]
+    dockerfile += run([cache_mounts(container, *CARGO_CACHE_DIRS)], cargo_commands)
+
+    dockerfile += """
+FROM toolchain
+LABEL org.opencontainers.image.source=https://github.com/KumoCorp/kumomta
+LABEL org.opencontainers.image.description="Build environment for CI"
+LABEL org.opencontainers.image.licenses="Apache"
+"""
+    dockerfile += run([], [f"curl -LsSf {nextest} | tar zxf - -C /usr/local/bin"])
+    dockerfile += "COPY ./get-deps.sh .\n"
+    dockerfile += run([package_cache], ["/tmp/get-deps.sh"])
+    if pip_packages:
+        # uv resolves and downloads in parallel, and unlike pip doesn't
+        # byte-compile everything that it installs
+        dockerfile += run(
+            [cache_mounts(container, "/root/.cache/uv")],
+            [
+                "curl -LsSf https://astral.sh/uv/install.sh | env UV_INSTALL_DIR=/usr/local/bin sh",
+                "uv pip install --system --quiet " + " ".join(pip_packages),
+            ],
+        )
+    # Only copy the tools themselves; copying the whole of bin would
+    # duplicate the rustup proxies into another layer
+    binaries = " ".join(
+        f"/root/.cargo/bin/{tool}" for tool in ["sccache"] + cargo_tools
+    )
+    dockerfile += f"COPY --from=cargo-tools {binaries} /root/.cargo/bin/\n"
+    # and bring along cargo's record of what it installed
+    dockerfile += (
+        "COPY --from=cargo-tools"
+        + " /root/.cargo/.crates.toml /root/.cargo/.crates2.json /root/.cargo/\n"
+    )
+
+    return dockerfile
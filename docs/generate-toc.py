@@ -1,99 +1,214 @@
 #!/usr/bin/env python3
-import base64
-import glob
 import json
 import os
 import re
-import subprocess
-import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# Titles extracted from markdown files are remembered across runs in
+# this file, keyed by filename, along with the mtime and size of the
+# file at the time, so that unchanged files don't need to be re-read.
+# Bump TITLE_CACHE_VERSION whenever read_title changes the titles that
+# it produces, so that stale titles from an older cache aren't reused.
+TITLE_CACHE_FILE = ".toc-title-cache.json"
+TITLE_CACHE_VERSION = 2
+PREV_TITLES = {}
+
+# Matches a markdown heading line, capturing its text
+TITLE_RE = re.compile(rb"#+[ \t]*(\S.*?)[ \t#]*\r?$")
+TITLES = {}
+
+
+def read_title(filename):
+    """Returns the text of the heading that a markdown file starts with,
+    after any front matter, or else its first line"""
+    with open(filename, "rb") as f:
+        line = f.readline()
+        if line.rstrip(b"\r\n") == b"---":
+            # Skip over YAML front matter, in which # introduces a comment
+            for line in f:
+                if line.rstrip(b"\r\n") == b"---":
+                    break
+            line = f.readline()
+        while line and not line.strip():
+            line = f.readline()
+    # Only a heading at the very start counts; anything else, such as a
+    # "# comment" in a later code block, isn't the title of the page
+    m = TITLE_RE.match(line)
+    if m:
+        return m.group(1).decode("utf-8")
+    return line.rstrip(b"\r\n").decode("utf-8").strip("#").strip()
+
+
+def extract_title(filename):
+    """Returns the title of a markdown file"""
+    st = os.stat(filename)
+    key = [st.st_mtime_ns, st.st_size]
+    cached = PREV_TITLES.get(filename)
+    if cached and cached[:2] == key:
+        title = cached[2]
+    else:
+        title = read_title(filename)
+    TITLES[filename] = key + [title]
+    return title
+
+
+def write_file(filename, content):
+    """Replaces the contents of filename with content.  The content is
+    written to a temporary file which is then renamed over filename, so
+    that an interrupted run can't leave a truncated file behind.
+    The file is left untouched if it already has that content, so that
+    mkdocs doesn't see it as modified and rebuild it"""
+    content = content.encode("utf-8")
+    try:
+        with open(filename, "rb") as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(content)
+    os.replace(tmp_filename, filename)
+
+
+# The indentation for each level of the nav, precomputed for all but
+# unusually deep levels
+INDENTS = tuple("  " * depth for depth in range(16))
 
 
 class Page(object):
     """A page in the TOC, and its optional children"""
 
+    __slots__ = ("title", "filename", "children")
+
     def __init__(self, title, filename, children=None):
         self.title = title
         self.filename = filename
         self.children = children or []
 
     def render(self, output, depth=0):
-        indent = "  " * depth
-        bullet = "- " if depth > 0 else ""
-        if depth > 0:
-            if len(self.children) == 0:
-                output.write(f'{indent}{bullet}"{self.title}": {self.filename}\n')
-            else:
-                output.write(f'{indent}{bullet}"{self.title}":\n')
-                if self.filename:
-                    output.write(f'{indent}  {bullet}"{self.title}": {self.filename}\n')
-        for kid in self.children:
-            kid.render(output, depth + 1)
+        # Walk the tree using an explicit stack rather than recursing.
+        # Generated entries know how to render themselves.
+        stack = [(self, depth)]
+        while stack:
+            page, depth = stack.pop()
+            if not isinstance(page, Page):
+                page.render(output, depth)
+                continue
+            # depth 0 is the root of the nav, which has no entry of its own
+            if depth > 0:
+                if depth < len(INDENTS):
+                    indent = INDENTS[depth]
+                else:
+                    indent = "  " * depth
+                if not page.children:
+                    output.append(f'{indent}- "{page.title}": {page.filename}\n')
+                else:
+                    output.append(f'{indent}- "{page.title}":\n')
+                    if page.filename:
+                        output.append(f'{indent}  - "{page.title}": {page.filename}\n')
+            stack.extend((kid, depth + 1) for kid in reversed(page.children))
 
 
-class Gen(object):
-    """autogenerate an index page from the contents of a directory"""
+class Generated(object):
+    """A TOC entry whose children and index page are generated from
+    the contents of a directory.  collect() does the filesystem work and
+    returns (children, index page content); it is independent for each
+    entry, so it is run ahead of time on a thread pool, with `collected`
+    holding the future for its result"""
 
-    def __init__(self, title, dirname, index=None, extract_title=False, reverse=False):
+    __slots__ = ("title", "dirname", "collected")
+
+    def __init__(self, title, dirname):
         self.title = title
         self.dirname = dirname
+        self.collected = None
+
+    def render(self, output, depth=0):
+        if self.collected is None:
+            children, index = self.collect()
+        else:
+            children, index = self.collected.result()
+
+        index_filename = f"{self.dirname}/index.md"
+        index_page = Page(self.title, index_filename, children=children)
+        index_page.render(output, depth)
+        write_file(index_filename, index)
+
+
+class Gen(Generated):
+    """autogenerate an index page from the contents of a directory"""
+
+    __slots__ = ("index", "extract_title", "reverse")
+
+    def __init__(self, title, dirname, index=None, extract_title=False, reverse=False):
+        super().__init__(title, dirname)
         self.index = index
         self.extract_title = extract_title
         self.reverse = reverse
 
-    def render(self, output, depth=0):
-        names = sorted(glob.glob(f"{self.dirname}/*.md"), reverse=self.reverse)
+    def collect(self):
+        # A single scandir pass; the dirent type tells us which entries
+        # are regular files without needing to stat them
+        with os.scandir(self.dirname) as entries:
+            names = [
+                (entry.name, entry.path)
+                for entry in entries
+                if entry.name.endswith(".md")
+                and not entry.name.startswith(".")
+                and entry.name not in ("index.md", "_index.md")
+                and entry.is_file()
+            ]
+        # Names within a directory are unique, so sort on the name alone
+        # rather than comparing whole tuples, and flip the result in place
+        # for the newest-first listings
+        names.sort(key=lambda item: item[0])
+        if self.reverse:
+            names.reverse()
         children = []
-        for filename in names:
-            title = os.path.basename(filename).rsplit(".", 1)[0]
-            if title == "index" or title == "_index":
-                continue
-
+        listing = []
+        for name, filename in names:
             if self.extract_title:
-                with open(filename, "r") as f:
-                    title = f.readline().strip("#").strip()
+                title = extract_title(filename)
+            else:
+                title = name[:-3]
 
             children.append(Page(title, filename))
+            listing.append(f"  - [{title}]({name})\n")
 
-        index_filename = f"{self.dirname}/index.md"
-        index_page = Page(self.title, index_filename, children=children)
-        index_page.render(output, depth)
-        with open(index_filename, "w") as idx:
-            if self.index:
-                idx.write(self.index)
-                idx.write("\n\n")
-            else:
-                try:
-                    with open(f"{self.dirname}/_index.md", "r") as f:
-                        idx.write(f.read())
-                        idx.write("\n\n")
-                except FileNotFoundError:
-                    pass
-            for page in children:
-                idx.write(f"  - [{page.title}]({os.path.basename(page.filename)})\n")
+        index = []
+        if self.index:
+            index.append(self.index)
+            index.append("\n\n")
+        else:
+            try:
+                with open(f"{self.dirname}/_index.md", "r") as f:
+                    index.append(f.read())
+                    index.append("\n\n")
+            except FileNotFoundError:
+                pass
 
+        return children, "".join(index + listing)
 
-class RustDoc(object):
+
+class RustDoc(Generated):
     """autogenerate an index page from the contents of a directory"""
 
-    def __init__(self, title, dirname):
-        self.title = title
-        self.dirname = dirname
+    __slots__ = ()
 
-    def render(self, output, depth=0):
-        names = sorted(glob.glob(f"{self.dirname}/*/index.html"))
+    def collect(self):
         children = []
-        for filename in names:
-            crate_name = os.path.dirname(filename)
-            title = os.path.basename(crate_name)
-
-            children.append(Page(title, filename))
+        with os.scandir(self.dirname) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or not entry.is_dir():
+                    continue
+                filename = f"{entry.path}/index.html"
+                if os.path.isfile(filename):
+                    children.append(Page(entry.name, filename))
+        children.sort(key=lambda page: page.title)
 
-        index_filename = f"{self.dirname}/index.md"
-        index_page = Page(self.title, index_filename, children=children)
-        index_page.render(output, depth)
-        with open(index_filename, "w") as idx:
-            idx.write(
-                """
+        index = [
+            """
 This section contains automatically generated documentation from
 the internal Rust code.  It is included in here to aid those
 hacking on the internals.
@@ -104,10 +219,46 @@ without any regard for backward compatibility.
 The following crates are part of the KumoMTA workspace:
 
 """
-            )
-            for page in children:
-                idx.write(f"  - [{page.title}]({page.title}/index.html)\n")
+        ]
+        for page in children:
+            index.append(f"  - [{page.title}]({page.title}/index.html)\n")
+
+        return children, "".join(index)
+
 
+def generated(pages):
+    """Yields the Generated entries from within pages"""
+    for page in pages:
+        if isinstance(page, Generated):
+            yield page
+        else:
+            yield from generated(page.children)
+
+
+# Lua modules, each documented in reference/<name>, in the order
+# that they appear in the TOC
+MODULES = [
+    "kumo",
+    "kumo.amqp",
+    "kumo.api.inject",
+    "kumo.digest",
+    "kumo.dkim",
+    "kumo.dns",
+    "kumo.encode",
+    "kumo.cidr",
+    "kumo.domain_map",
+    "kumo.http",
+    "kumo.kafka",
+    "kumo.regex_set_map",
+    "kumo.secrets",
+    "kumo.serde",
+    "kumo.shaping",
+    "redis",
+    "regex",
+    "sqlite",
+    "string",
+    "tsa",
+]
 
 TOC = [
     Page(
@@ -314,86 +465,7 @@ TOC = [
             Page("Queues", "reference/queues.md"),
             Page("Log Record", "reference/log_record.md"),
             Gen("kcli", "reference/kcli", extract_title=True),
-            Gen(
-                "module: kumo",
-                "reference/kumo",
-            ),
-            Gen(
-                "module: kumo.amqp",
-                "reference/kumo.amqp",
-            ),
-            Gen(
-                "module: kumo.api.inject",
-                "reference/kumo.api.inject",
-            ),
-            Gen(
-                "module: kumo.digest",
-                "reference/kumo.digest",
-            ),
-            Gen(
-                "module: kumo.dkim",
-                "reference/kumo.dkim",
-            ),
-            Gen(
-                "module: kumo.dns",
-                "reference/kumo.dns",
-            ),
-            Gen(
-                "module: kumo.encode",
-                "reference/kumo.encode",
-            ),
-            Gen(
-                "module: kumo.cidr",
-                "reference/kumo.cidr",
-            ),
-            Gen(
-                "module: kumo.domain_map",
-                "reference/kumo.domain_map",
-            ),
-            Gen(
-                "module: kumo.http",
-                "reference/kumo.http",
-            ),
-            Gen(
-                "module: kumo.kafka",
-                "reference/kumo.kafka",
-            ),
-            Gen(
-                "module: kumo.regex_set_map",
-                "reference/kumo.regex_set_map",
-            ),
-            Gen(
-                "module: kumo.secrets",
-                "reference/kumo.secrets",
-            ),
-            Gen(
-                "module: kumo.serde",
-                "reference/kumo.serde",
-            ),
-            Gen(
-                "module: kumo.shaping",
-                "reference/kumo.shaping",
-            ),
-            Gen(
-                "module: redis",
-                "reference/redis",
-            ),
-            Gen(
-                "module: regex",
-                "reference/regex",
-            ),
-            Gen(
-                "module: sqlite",
-                "reference/sqlite",
-            ),
-            Gen(
-                "module: string",
-                "reference/string",
-            ),
-            Gen(
-                "module: tsa",
-                "reference/tsa",
-            ),
+            *[Gen(f"module: {name}", f"reference/{name}") for name in MODULES],
             Gen(
                 "object: address",
                 "reference/address",
@@ -440,9 +512,33 @@ TOC = [
 
 os.chdir("docs")
 
-with open("../mkdocs.yml", "w") as f:
-    f.write("# this is auto-generated by docs/generate-toc.py, do not edit\n")
-    f.write("INHERIT: mkdocs-base.yml\n")
-    f.write("nav:\n")
-    for page in TOC:
-        page.render(f, depth=1)
+try:
+    with open(TITLE_CACHE_FILE, "r") as f:
+        cache = json.load(f)
+    if isinstance(cache, dict) and cache.get("version") == TITLE_CACHE_VERSION:
+        PREV_TITLES = cache["titles"]
+except (FileNotFoundError, ValueError):
+    pass
+
+with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as pool:
+    for gen in generated(TOC):
+        gen.collected = pool.submit(gen.collect)
+
+# The nav is accumulated as a list of fragments and written in one go
+nav = [
+    "# this is auto-generated by docs/generate-toc.py, do not edit\n",
+    "INHERIT: mkdocs-base.yml\n",
+    "nav:\n",
+]
+for page in TOC:
+    page.render(nav, depth=1)
+
+write_file("../mkdocs.yml", "".join(nav))
+
+# Only retain the titles that we used this time around, so that
+# deleted files don't linger in the cache.  The titles are collected
+# concurrently, so sort them to keep the file stable between runs.
+write_file(
+    TITLE_CACHE_FILE,
+    json.dumps({"version": TITLE_CACHE_VERSION, "titles": TITLES}, sort_keys=True),
+)
@@ -1,48 +1,60 @@
 import json
 
-# https://mkdocs-macros-plugin.readthedocs.io/en/latest/macros/
-def define_env(env):
-    @env.macro
-    # Set indent=True when you want to define a box containing version-specific info.
-    #
-    # Set inline=True when you want to define a simple inline version indicator,
-    # such as when emitting information into a table row.
-    def since(vers, indent=False, inline=False):
 
-        scope = "section"
-        expanded = ""
-        expander = "???"
-        rule = ""
-        if indent:
-            scope = "outlined box"
-            expander = "!!!"
-            rule = "    <hr/>"
-
-        if vers == "dev":
-            first_line = "*Since: Dev Builds Only*"
-            if scope != "section":
-                expanded = "+"
-            blurb = f"""
+def since_template(dev, indent):
+    """Returns the markdown emitted by the since() macro for the
+    given mode, with a {vers} placeholder for the version"""
+
+    scope = "section"
+    expander = "???"
+    rule = ""
+    if indent:
+        scope = "outlined box"
+        expander = "!!!"
+        rule = "    <hr/>"
+
+    if dev:
+        first_line = "*Since: Dev Builds Only*"
+        blurb = f"""
     *The functionality described in this {scope} requires a dev build of KumoMTA.
     You can obtain a dev build by following the instructions in the
     [Installation](/userguide/installation/linux/) section.*
 """
-        else:
-            first_line = f"*Since: Version {vers}*"
-            blurb = f"""
-    *The functionality described in this {scope} requires version {vers} of KumoMTA,
+    else:
+        first_line = "*Since: Version {vers}*"
+        blurb = f"""
+    *The functionality described in this {scope} requires version {{vers}} of KumoMTA,
     or a more recent version.*
 """
 
-        if inline:
-            return f"({first_line})"
-
-        # If we're not expandable, don't emit the expanded marker
-        if expander == "!!!":
-            expanded = ""
-
-        return f"""
-{expander}{expanded} info "{first_line}"
+    return f"""
+{expander} info "{first_line}"
 {blurb}
 {rule}
 """
+
+
+# since() is used all over the docs, and only the version varies
+# between calls in the same mode, so build each variant just once
+SINCE_TEMPLATES = {
+    (dev, indent): since_template(dev, indent)
+    for dev in (False, True)
+    for indent in (False, True)
+}
+SINCE_INLINE_DEV = "(*Since: Dev Builds Only*)"
+
+
+# https://mkdocs-macros-plugin.readthedocs.io/en/latest/macros/
+def define_env(env):
+    @env.macro
+    # Set indent=True when you want to define a box containing version-specific info.
+    #
+    # Set inline=True when you want to define a simple inline version indicator,
+    # such as when emitting information into a table row.
+    def since(vers, indent=False, inline=False):
+        if inline:
+            if vers == "dev":
+                return SINCE_INLINE_DEV
+            return f"(*Since: Version {vers}*)"
+
+        return SINCE_TEMPLATES[(vers == "dev", bool(indent))].format(vers=vers)